@@ -12,13 +12,17 @@ from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 from timm.models.registry import register_model
 from timm.models.vision_transformer import _cfg
 from mmseg.models.builder import BACKBONES
+from mmseg.ops import flash_window_attn, flash_window_attn_supported
 from mmseg.utils import get_root_logger
 from mmcv.runner import load_checkpoint
 import math
+import warnings
 
 
 from .mix_transformer import mit_b4
-from einops import repeat, rearrange
+
+# `scale` was added to F.scaled_dot_product_attention in torch 2.1
+_HAS_SDPA = tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1)
 
 
 def window_partition(x, window_size):
@@ -32,7 +36,9 @@ def window_partition(x, window_size):
     """
     B, H, W, C = x.shape
     x = x.view(B, H // window_size[0], window_size[0], W // window_size[1], window_size[1], C)
-    windows = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, window_size[0], window_size[1], C)
+    # reshape is a free view only for a single column of windows (W == window_size[1]),
+    # where the permuted strides merge; with several columns it still copies
+    windows = x.permute(0, 1, 3, 2, 4, 5).reshape(-1, window_size[0], window_size[1], C)
     return windows
 
 
@@ -41,18 +47,61 @@ def window_reverse(windows, window_size, H, W):
     Args:
         windows: (num_windows*B, window_size, window_size, C)
         window_size (int): Window size
-        H (int): Height of image
-        W (int): Width of image
+        H (int): Height of image, the windows may cover a padded height
+        W (int): Width of image, the windows may cover a padded width
 
     Returns:
         x: (B, H, W, C)
     """
-    B = int(windows.shape[0] / (H * W / window_size[0] / window_size[1]))
-    x = windows.view(B, H // window_size[0], W // window_size[0], window_size[1], window_size[1], -1)
-    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
+    wh, ww = window_size
+    nh, nw = -(-H // wh), -(-W // ww)
+    C = windows.shape[-1]
+    windows = windows.view(-1, nh, nw, wh, ww, C).permute(0, 1, 3, 2, 4, 5)  # B, nh, wh, nw, ww, C
+    x = windows.new_empty((windows.shape[0], H, W, C))
+
+    # copy the full windows, then the cropped last row / column of windows
+    # straight into the output, so padding costs no extra crop copy
+    fh, fw = H // wh, W // ww
+    rows = [(0, fh, wh)] + ([(fh, fh + 1, H - fh * wh)] if H % wh else [])
+    cols = [(0, fw, ww)] + ([(fw, fw + 1, W - fw * ww)] if W % ww else [])
+    for h0, h1, hk in rows:
+        for w0, w1, wk in cols:
+            if h1 > h0 and w1 > w0:
+                out = x[:, h0 * wh:h0 * wh + (h1 - h0) * hk, w0 * ww:w0 * ww + (w1 - w0) * wk]
+                out.view(-1, h1 - h0, hk, w1 - w0, wk, C).copy_(windows[:, h0:h1, :hk, w0:w1, :wk])
     return x
 
 
+def dot_product_attention(q, k, v, scale, dropout_p=0.):
+    """
+    Args:
+        q, k, v: (B, num_heads, N, head_dim)
+        scale (float): Scale applied to q @ k^T
+        dropout_p (float): Dropout ratio of attention weight
+
+    Returns:
+        x: (B, num_heads, N, head_dim)
+    """
+    if _HAS_SDPA:
+        # dispatches to the fused flash / memory-efficient kernels, the
+        # (B, num_heads, N, N) score matrix is never materialized
+        return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, scale=scale)
+
+    B, num_heads, N, head_dim = q.shape
+    q, k, v = (t.reshape(B * num_heads, -1, head_dim) for t in (q, k, v))
+    # scale folded into the batched GEMM, beta=0 ignores the uninitialized input
+    attn = torch.baddbmm(q.new_empty(B * num_heads, N, k.shape[1]), q, k.transpose(-2, -1),
+                         beta=0, alpha=scale)
+    if q.dtype in (torch.float16, torch.bfloat16):
+        # one kernel that upcasts internally, keeps half precision scores stable
+        attn = F.softmax(attn, dim=-1, dtype=torch.float32).to(q.dtype)
+    else:
+        attn = F.softmax(attn, dim=-1)
+    if dropout_p > 0.:
+        attn = F.dropout(attn, dropout_p)
+    return torch.bmm(attn, v).view(B, num_heads, N, head_dim)
+
+
 class ClassiqueMlp(nn.Module):
     """ Multilayer perceptron."""
 
@@ -63,14 +112,18 @@ class ClassiqueMlp(nn.Module):
         self.fc1 = nn.Linear(in_features, hidden_features)
         self.act = act_layer()
         self.fc2 = nn.Linear(hidden_features, out_features)
-        self.drop = nn.Dropout(drop)
+        # functional dropout, so a zero ratio launches nothing
+        self.drop_p = drop
 
     def forward(self, x):
+        drop_p = self.drop_p if self.training else 0.
         x = self.fc1(x)
         x = self.act(x)
-        x = self.drop(x)
+        if drop_p > 0.:
+            x = F.dropout(x, drop_p)
         x = self.fc2(x)
-        x = self.drop(x)
+        if drop_p > 0.:
+            x = F.dropout(x, drop_p)
         return x
 
 class ClassicAttention(nn.Module):
@@ -94,11 +147,9 @@ class ClassicAttention(nn.Module):
         self.scale = qk_scale or head_dim ** -0.5
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
-        self.attn_drop = nn.Dropout(attn_drop)
+        self.attn_drop_p = attn_drop
         self.proj = nn.Linear(dim, dim)
-        self.proj_drop = nn.Dropout(proj_drop)
-
-        self.softmax = nn.Softmax(dim=-1)
+        self.proj_drop_p = proj_drop
 
 
     def forward(self, x, pe):
@@ -109,23 +160,23 @@ class ClassicAttention(nn.Module):
         """
         B_, N, C = x.shape
 
-        m = pe.shape[0]
-        strt = m//2-N//2
-        pe = pe[strt:strt+N,:]
-        x = x + pe
+        strt = pe.shape[0] // 2 - N // 2
+        pe = pe.narrow(0, strt, N)  # a contiguous view, rows of pe are contiguous
 
-        qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        # qkv(x + pe) == qkv(x) + W_qkv @ pe: project the (N, C) positional
+        # embedding instead of adding it to the (B_, N, C) activations, and
+        # feed it with the qkv bias as the per-token bias of a single batched GEMM
+        bias = F.linear(pe, self.qkv.weight, self.qkv.bias)
+        qkv = torch.baddbmm(bias, x, self.qkv.weight.t().expand(B_, -1, -1))
+        qkv = qkv.reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-
-        attn = self.softmax(attn)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+        x = dot_product_attention(q, k, v, self.scale,
+                                  dropout_p=self.attn_drop_p if self.training else 0.)
+        x = x.transpose(1, 2).reshape(B_, N, C)
         x = self.proj(x)
-        x = self.proj_drop(x)
+        if self.training and self.proj_drop_p > 0.:
+            x = F.dropout(x, self.proj_drop_p)
         return x
 
 
@@ -138,11 +189,15 @@ class Attention(nn.Module):
         self.num_heads = attn.num_heads
         self.scale = attn.scale
 
-        self.q = attn.q
-        self.kv = attn.kv
-        self.attn_drop = attn.attn_drop
+        # fuse the q and kv projections into a single GEMM over x_windows
+        self.qkv = nn.Linear(self.dim, self.dim * 3, bias=attn.q.bias is not None)
+        with torch.no_grad():
+            self.qkv.weight.copy_(torch.cat([attn.q.weight, attn.kv.weight], dim=0))
+            if self.qkv.bias is not None:
+                self.qkv.bias.copy_(torch.cat([attn.q.bias, attn.kv.bias], dim=0))
+        self.attn_drop_p = attn.attn_drop.p
         self.proj = attn.proj
-        self.proj_drop = attn.proj_drop
+        self.proj_drop_p = attn.proj_drop.p
 
         self.sr_ratio = attn.sr_ratio
         if self.sr_ratio > 1:
@@ -152,6 +207,15 @@ class Attention(nn.Module):
         self.gt_num = gt_num
         self.window_size = window_size
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the q/kv fusion store them separately
+        for name in ('weight', 'bias'):
+            # fuse only complete pairs, anything else is reported as a missing key
+            if prefix + 'q.' + name in state_dict and prefix + 'kv.' + name in state_dict:
+                state_dict[prefix + 'qkv.' + name] = torch.cat(
+                    [state_dict.pop(prefix + 'q.' + name), state_dict.pop(prefix + 'kv.' + name)], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x, H, W, gt):
         B_, N_, C = x.shape
         gt_num = self.gt_num
@@ -161,58 +225,40 @@ class Attention(nn.Module):
         pad_l = pad_t = 0
         pad_b = (self.window_size[0] - H % self.window_size[0]) % self.window_size[0]
         pad_r = (self.window_size[1] - W % self.window_size[1]) % self.window_size[1]
-        x = F.pad(x, (0, 0, pad_l, pad_r, pad_t, pad_b))
-        _, Hp, Wp, _ = x.shape
+        if pad_r > 0 or pad_b > 0:
+            x = F.pad(x, (0, 0, pad_l, pad_r, pad_t, pad_b))
 
         x_windows = window_partition(x, self.window_size)  # nW*B, window_size, window_size, C
         x_windows = x_windows.view(-1, self.window_size[0] * self.window_size[1], C)  # nW*B, window_size*window_size, C
-        # x_windows = x
         B, N_, C = x_windows.shape
 
 
         if self.gt_num != 0:
-            if len(gt.shape) != 3:
-                gt = repeat(gt, "g c -> b g c", b=B)# shape of (num_windows*B, G, C)
-            x_windows = torch.cat([gt, x_windows], dim=1)
+            x_windows = torch.cat([gt, x_windows], dim=1)  # gt: (num_windows*B, G, C)
       
         B, N, C = x_windows.shape
 
-        q = self.q(x_windows).reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
-
-        # if self.sr_ratio > 1:
-        #     if gt_num != 0:
-        #         x_ = x[:,gt_num:,:].permute(0, 2, 1).reshape(B, C, H, W)
-        #         x_ = self.sr(x_).reshape(B, C, -1).permute(0, 2, 1)
-        #         x_ = self.norm(x_)
-        #         x_ = torch.cat([gt, x_], dim=1)
-        #     else:
-        #         x_ = x.permute(0, 2, 1).reshape(B, C, H, W)
-        #         x_ = self.sr(x_).reshape(B, C, -1).permute(0, 2, 1)
-        #         x_ = self.norm(x_)
-        #     kv = self.kv(x_).reshape(B, -1, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-
-        # else:
-        #     kv = self.kv(x).reshape(B, -1, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-        kv = self.kv(x_windows).reshape(B, -1, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-        k, v = kv[0], kv[1]
-
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
-        x = self.proj(x)
-        x = self.proj_drop(x)
+        # project (B*N, C) matrices so nn.Linear takes the addmm fast path
+        qkv = self.qkv(x_windows.reshape(B * N, C))
+        qkv = qkv.view(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+
+        dropout_p = self.attn_drop_p if self.training else 0.
+        if flash_window_attn_supported(q, dropout_p):
+            x = flash_window_attn(q, k, v, self.scale)
+        else:
+            x = dot_product_attention(q, k, v, self.scale, dropout_p=dropout_p)
+        x = x.transpose(1, 2).reshape(B * N, C)
+        x = self.proj(x).view(B, N, C)
+        if self.training and self.proj_drop_p > 0.:
+            x = F.dropout(x, self.proj_drop_p)
 
 
         gt = x[:,:gt_num,:]
         x = x[:,gt_num:,:]
 
         x = x.view(-1, self.window_size[0], self.window_size[1], C)
-        x = window_reverse(x, self.window_size, Hp, Wp)  # B H' W' C
-
-        if pad_r > 0 or pad_b > 0:
-            x = x[:, :H, :W, :].contiguous()
+        x = window_reverse(x, self.window_size, H, W)  # B H W C, padding cropped
         x = x.view(B_, H * W, C)
 
         return x, gt
@@ -223,7 +269,7 @@ class Block(nn.Module):
                  drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, sr_ratio=1, window_size=(8,8), do_gmsa=True):
         super().__init__()
         self.norm1 = block.norm1
-        self.attn = Attention(block.attn, gt_num)
+        self.attn = Attention(block.attn, gt_num, window_size)
         self.drop_path = block.drop_path
         self.norm2 = block.norm2
         self.mlp = block.mlp
@@ -242,31 +288,36 @@ class Block(nn.Module):
             self.gt_norm1 = norm_layer(dim)
             self.gt_norm2 = norm_layer(dim)
 
+    def _residual(self, skip, x):
+        """skip + drop_path(x). When no graph is recorded and drop path is an
+        identity, x (a fresh branch output) is accumulated in place."""
+        if torch.is_grad_enabled() or x.dtype != skip.dtype or (
+                self.training and getattr(self.drop_path, 'drop_prob', 0.) > 0.):
+            return skip + self.drop_path(x)
+        return x.add_(skip)
+
     def forward(self, x, H, W, gt, pe):
         
         skip = x
         skip_gt = gt
         x = self.norm1(x)
         x, gt = self.attn(x, H, W, gt)
-        B = gt.shape[0]
         # x =self.attn(x, H, W)
-        x = skip + self.drop_path(x)
-        x = x + self.drop_path(self.mlp(self.norm2(x), H, W))
+        x = self._residual(skip, x)
+        x = self._residual(x, self.mlp(self.norm2(x), H, W))
 
         if self.gt_num != 0 and self.do_gmsa:
-            if len(skip_gt.shape) != 3:
-                skip_gt = repeat(skip_gt, "g c -> b g c", b=B)
-            gt = skip_gt + self.drop_path(self.gt_mlp1(self.norm2(gt)))
+            gt = self._residual(skip_gt, self.gt_mlp1(self.norm2(gt)))
 
 
             # do g msa
             B, ngt, c = gt.shape
             nw = B//x.shape[0]
-            gt =rearrange(gt, "(b n) g c -> b (n g) c", n=nw)
+            gt = gt.view(-1, nw * ngt, c)  # (b n) g c -> b (n g) c
 
-            gt = gt + self.drop_path(self.gt_attn(self.gt_norm1(gt), pe))
-            gt = gt + self.drop_path(self.gt_mlp2(self.gt_norm2(gt)))
-            gt = rearrange(gt, "b (n g) c -> (b n) g c",g=ngt, c=c)
+            gt = self._residual(gt, self.gt_attn(self.gt_norm1(gt), pe))
+            gt = self._residual(gt, self.gt_mlp2(self.gt_norm2(gt)))
+            gt = gt.view(-1, ngt, c)  # b (n g) c -> (b n) g c
 
         return x, gt
 
@@ -278,33 +329,38 @@ class Block(nn.Module):
 @BACKBONES.register_module()
 class SegFormerGTOmega(nn.Module):
     """docstring for SegFormerGTOmega"""
-    def __init__(self, gt_num = 10):
+    def __init__(self, gt_num = 10, allow_tf32=None, compile_blocks=False, compile_mlps=False):
         super(SegFormerGTOmega, self).__init__()
         self.gt_num = gt_num
+        self.compile_blocks = compile_blocks
+        self.compile_mlps = compile_mlps
+        if compile_blocks and not hasattr(torch, 'compile'):
+            raise RuntimeError('compile_blocks=True requires torch>=2.0 (torch.compile), '
+                               f'but torch {torch.__version__} is installed')
+        if compile_mlps and not hasattr(nn.Module, 'compile'):
+            raise RuntimeError('compile_mlps=True requires torch>=2.2 (nn.Module.compile), '
+                               f'but torch {torch.__version__} is installed')
+        if compile_blocks and compile_mlps:
+            warnings.warn('compile_mlps is ignored when compile_blocks=True, '
+                          'the compiled blocks already cover the mlps')
+
+        if allow_tf32 is not None:
+            # process-wide switch: True lets the many small attention / mlp GEMMs
+            # run on the tensor cores (Ampere+), False keeps full fp32 matmuls.
+            # None leaves the current torch settings untouched.
+            torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+            torch.backends.cudnn.allow_tf32 = allow_tf32
         self.embed_dims=[64, 128, 320, 512]
         self.num_heads=[1, 2, 5, 8]
         self.window_size=(8,8)
 
 
-        self.global_token1 = torch.nn.Parameter(torch.randn(gt_num,self.embed_dims[0]))
-        ws_pe = (40*gt_num//(2**0), 40*gt_num//(2**0))
-        self.pe1 = nn.Parameter(torch.zeros(ws_pe[0]*ws_pe[1], self.embed_dims[0]))
-        trunc_normal_(self.pe1, std=.02)
-
-        self.global_token2 = torch.nn.Parameter(torch.randn(gt_num,self.embed_dims[1]))
-        ws_pe = (40*gt_num//(2**1), 40*gt_num//(2**1))
-        self.pe2 = nn.Parameter(torch.zeros(ws_pe[0]*ws_pe[1], self.embed_dims[1]))
-        trunc_normal_(self.pe2, std=.02)
-
-        self.global_token3 = torch.nn.Parameter(torch.randn(gt_num,self.embed_dims[2]))
-        ws_pe = (40*gt_num//(2**2), 40*gt_num//(2**2))
-        self.pe3 = nn.Parameter(torch.zeros(ws_pe[0]*ws_pe[1], self.embed_dims[2]))
-        trunc_normal_(self.pe3, std=.02)
-
-        self.global_token4 = torch.nn.Parameter(torch.randn(gt_num,self.embed_dims[3]))
-        ws_pe = (40*gt_num//(2**3), 40*gt_num//(2**3))
-        self.pe4 = nn.Parameter(torch.zeros(ws_pe[0]*ws_pe[1], self.embed_dims[3]))
-        trunc_normal_(self.pe4, std=.02)
+        # global_token{i} / pe{i} of each stage, the pe table shrinks with the resolution
+        for i, dim in enumerate(self.embed_dims):
+            self.register_parameter(f'global_token{i + 1}', nn.Parameter(torch.randn(gt_num, dim)))
+            ws_pe = 40 * gt_num // (2 ** i)
+            self.register_parameter(f'pe{i + 1}', nn.Parameter(torch.zeros(ws_pe * ws_pe, dim)))
+            trunc_normal_(getattr(self, f'pe{i + 1}'), std=.02)
 
 
 
@@ -360,13 +416,52 @@ class SegFormerGTOmega(nn.Module):
             for i in range(depths[3])])
         self.norm4 = mix.norm4
 
+        if self.compile_blocks:
+            # one frame for the whole stage loop: all 41 blocks share the code of
+            # Block.forward, so compiling them one by one runs into dynamo's
+            # recompile limit and leaves most of them eager. Only the bound method
+            # is replaced, the state dict keys are unchanged.
+            self.forward_features = torch.compile(self.forward_features, mode="reduce-overhead",
+                                                  fullgraph=False)
+        elif self.compile_mlps:
+            # only the mlps (fc1 -> dwconv -> act -> fc2 and the gt mlps), dynamic
+            # shapes so varying H, W do not recompile, inductor fuses act/dropout into the GEMM epilogues
+            for blk in [*self.block1, *self.block2, *self.block3, *self.block4]:
+                for mlp in (blk.mlp, getattr(blk, 'gt_mlp1', None), getattr(blk, 'gt_mlp2', None)):
+                    if mlp is not None:
+                        mlp.compile(dynamic=True)
+
+    @torch.no_grad()
+    def quantize_for_inference(self, dtype=torch.qint8):
+        """Swap the Linear layers of the transformer blocks (attn.qkv, attn.proj,
+        the mlp and gt_mlp fc1/fc2 and gt_attn.proj) for dynamically quantized
+        copies, qint8 or float16 weights. The quantized kernels run on CPU.
+
+        gt_attn.qkv is kept as is since its weight also projects the
+        positional embedding.
+        """
+        if any(p.is_cuda for p in self.parameters()):
+            raise RuntimeError('quantize_for_inference produces CPU-only kernels, '
+                               'move the model to CPU first')
+        names = [name for name, m in self.named_modules()
+                 if name.startswith('block') and isinstance(m, nn.Linear)
+                 and not name.endswith('gt_attn.qkv')]
+        torch.quantization.quantize_dynamic(self, set(names), dtype=dtype, inplace=True)
+        return self
+
+    def _expand_gt(self, gt, B, H, W):
+        """Broadcast the (G, C) global tokens of a stage to every window once,
+        as a (num_windows*B, G, C) view, instead of in each block."""
+        num_windows = math.ceil(H / self.window_size[0]) * math.ceil(W / self.window_size[1])
+        return gt.unsqueeze(0).expand(B * num_windows, -1, -1)
+
     def forward_features(self, x):
         B = x.shape[0]
         outs = []
 
         # stage 1
         x, H, W = self.patch_embed1(x)
-        gt = self.global_token1
+        gt = self._expand_gt(self.global_token1, B, H, W)
         for i, blk in enumerate(self.block1):
             x, gt = blk(x, H, W, gt, self.pe1)
         x = self.norm1(x)
@@ -375,7 +470,7 @@ class SegFormerGTOmega(nn.Module):
 
         # stage 2
         x, H, W = self.patch_embed2(x)
-        gt = self.global_token2
+        gt = self._expand_gt(self.global_token2, B, H, W)
         for i, blk in enumerate(self.block2):
             x, gt = blk(x, H, W, gt, self.pe2)
         x = self.norm2(x)
@@ -384,7 +479,7 @@ class SegFormerGTOmega(nn.Module):
 
         # stage 3
         x, H, W = self.patch_embed3(x)
-        gt = self.global_token3
+        gt = self._expand_gt(self.global_token3, B, H, W)
         for i, blk in enumerate(self.block3):
             x, gt = blk(x, H, W, gt, self.pe3)
         x = self.norm3(x)
@@ -393,7 +488,7 @@ class SegFormerGTOmega(nn.Module):
 
         # stage 4
         x, H, W = self.patch_embed4(x)
-        gt = self.global_token4
+        gt = self._expand_gt(self.global_token4, B, H, W)
         for i, blk in enumerate(self.block4):
             x, gt = blk(x, H, W, gt, self.pe4)
         x = self.norm4(x)
@@ -1,4 +1,9 @@
 from .encoding import Encoding
+from .flash_window_attention import (flash_window_attn,
+                                     flash_window_attn_supported)
 from .wrappers import Upsample, resize
 
-__all__ = ['Upsample', 'resize', 'Encoding']
+__all__ = [
+    'Upsample', 'resize', 'Encoding', 'flash_window_attn',
+    'flash_window_attn_supported'
+]
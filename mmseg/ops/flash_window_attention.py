@@ -0,0 +1,141 @@
+import inspect
+
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+# a whole window (window_size**2 tokens plus the global tokens) must fit in
+# one tile of scores
+MAX_WINDOW_TOKENS = 128
+BLOCK_D = 16
+
+if triton is not None:
+    # triton>=3 replaced tl.dot(allow_tf32=...) by tl.dot(input_precision=...)
+    _HAS_INPUT_PRECISION = tl.constexpr(
+        'input_precision' in inspect.signature(tl.dot).parameters)
+
+    @triton.jit
+    def _dot(a, b, ALLOW_TF32: tl.constexpr):
+        if _HAS_INPUT_PRECISION:
+            if ALLOW_TF32:
+                out = tl.dot(a, b, input_precision='tf32')
+            else:
+                out = tl.dot(a, b, input_precision='ieee')
+        else:
+            out = tl.dot(a, b, allow_tf32=ALLOW_TF32)
+        return out
+
+    @triton.jit
+    def _flash_window_attn_fwd_kernel(
+            Q, K, V, Out, scale,
+            stride_qb, stride_qh, stride_qn, stride_qd,
+            stride_kb, stride_kh, stride_kn, stride_kd,
+            stride_vb, stride_vh, stride_vn, stride_vd,
+            stride_ob, stride_oh, stride_on, stride_od,
+            N, HEAD_DIM: tl.constexpr, BLOCK_N: tl.constexpr,
+            BLOCK_D: tl.constexpr, ALLOW_TF32: tl.constexpr):
+        pid_b = tl.program_id(0)
+        pid_h = tl.program_id(1)
+        offs_n = tl.arange(0, BLOCK_N)
+        offs_d = tl.arange(0, BLOCK_D)
+        mask_n = offs_n < N
+
+        q_ptr = Q + pid_b * stride_qb + pid_h * stride_qh
+        k_ptr = K + pid_b * stride_kb + pid_h * stride_kh
+        v_ptr = V + pid_b * stride_vb + pid_h * stride_vh
+        o_ptr = Out + pid_b * stride_ob + pid_h * stride_oh
+
+        # q @ k^T, accumulated over chunks of BLOCK_D features
+        s = tl.zeros((BLOCK_N, BLOCK_N), dtype=tl.float32)
+        for d in range(0, HEAD_DIM, BLOCK_D):
+            q = tl.load(
+                q_ptr + offs_n[:, None] * stride_qn +
+                (d + offs_d)[None, :] * stride_qd,
+                mask=mask_n[:, None], other=0.)
+            k = tl.load(
+                k_ptr + offs_n[:, None] * stride_kn +
+                (d + offs_d)[None, :] * stride_kd,
+                mask=mask_n[:, None], other=0.)
+            s += _dot(q, tl.trans(k), ALLOW_TF32)
+        s = s * scale
+        s = tl.where(mask_n[None, :], s, float('-inf'))
+
+        # the window fits in a single tile, so the softmax is exact in one pass
+        p = tl.exp(s - tl.max(s, axis=1)[:, None])
+        p = p / tl.sum(p, axis=1)[:, None]
+        p = p.to(V.dtype.element_ty)
+
+        for d in range(0, HEAD_DIM, BLOCK_D):
+            v = tl.load(
+                v_ptr + offs_n[:, None] * stride_vn +
+                (d + offs_d)[None, :] * stride_vd,
+                mask=mask_n[:, None], other=0.)
+            o = _dot(p, v, ALLOW_TF32)
+            tl.store(
+                o_ptr + offs_n[:, None] * stride_on +
+                (d + offs_d)[None, :] * stride_od,
+                o.to(Out.dtype.element_ty), mask=mask_n[:, None])
+
+
+class FlashWindowAttention(torch.autograd.Function):
+    """Fused window attention, the (N, N) scores of each window and head stay
+    in SRAM. The backward pass recomputes the attention map with regular
+    ops."""
+
+    @staticmethod
+    def forward(ctx, q, k, v, scale):
+        B, num_heads, N, head_dim = q.shape
+        out = q.new_empty((B, num_heads, N, head_dim))
+        block_n = max(16, triton.next_power_of_2(N))
+        _flash_window_attn_fwd_kernel[(B, num_heads)](
+            q, k, v, out, scale,
+            *q.stride(), *k.stride(), *v.stride(), *out.stride(),
+            N, HEAD_DIM=head_dim, BLOCK_N=block_n, BLOCK_D=BLOCK_D,
+            # fp32 inputs follow torch's matmul setting, like the backward
+            ALLOW_TF32=(q.dtype != torch.float32
+                        or torch.backends.cuda.matmul.allow_tf32),
+            num_warps=4 if block_n <= 64 else 8)
+        ctx.save_for_backward(q, k, v)
+        ctx.scale = scale
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        q, k, v = ctx.saved_tensors
+        with torch.enable_grad():
+            q, k, v = (t.detach().requires_grad_() for t in (q, k, v))
+            attn = ((q @ k.transpose(-2, -1)) * ctx.scale).softmax(dim=-1)
+            out = attn @ v
+        dq, dk, dv = torch.autograd.grad(out, (q, k, v), grad_out)
+        return dq, dk, dv, None
+
+
+def flash_window_attn(q, k, v, scale):
+    """
+    Args:
+        q, k, v: (num_windows*B, num_heads, N, head_dim)
+        scale (float): Scale applied to q @ k^T
+
+    Returns:
+        x: (num_windows*B, num_heads, N, head_dim)
+    """
+    return FlashWindowAttention.apply(q, k, v, scale)
+
+
+def flash_window_attn_supported(q, dropout_p=0.):
+    """Whether ``flash_window_attn`` can be used for ``q``: needs triton, a
+    CUDA fp16/bf16/fp32 tensor, no attention dropout, N <= MAX_WINDOW_TOKENS
+    and a head dim divisible by BLOCK_D.
+
+    Only used for inference: the recomputing backward materializes the full
+    attention map, where SDPA has a fused backward.
+    """
+    return (triton is not None and q.is_cuda and dropout_p == 0.
+            and not (torch.is_grad_enabled() and q.requires_grad)
+            and q.dtype in (torch.float16, torch.bfloat16, torch.float32)
+            and q.shape[-2] <= MAX_WINDOW_TOKENS
+            and q.shape[-1] % BLOCK_D == 0)
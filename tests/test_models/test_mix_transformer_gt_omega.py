@@ -0,0 +1,198 @@
+import pytest
+import torch
+
+from mmseg.models.backbones.mix_transformer import Attention as MiTAttention
+from mmseg.models.backbones.mix_transformer import Block as MiTBlock
+from mmseg.models.backbones.mix_transformer_gt_omega import (
+    Attention, Block, ClassicAttention, SegFormerGTOmega,
+    dot_product_attention, window_partition, window_reverse)
+from mmseg.ops import (flash_window_attention, flash_window_attn,
+                       flash_window_attn_supported)
+
+
+def test_omega_attention_load_unfused_qkv():
+    mit_attn = MiTAttention(64, num_heads=1, qkv_bias=True)
+    attn = Attention(MiTAttention(64, num_heads=1, qkv_bias=True))
+
+    # checkpoints saved before the q/kv fusion store them separately
+    state_dict = {
+        k: v
+        for k, v in mit_attn.state_dict().items()
+        if k.startswith(('q.', 'kv.', 'proj.'))
+    }
+    attn.load_state_dict(state_dict)
+    assert torch.equal(
+        attn.qkv.weight,
+        torch.cat([mit_attn.q.weight, mit_attn.kv.weight], dim=0))
+    assert torch.equal(
+        attn.qkv.bias, torch.cat([mit_attn.q.bias, mit_attn.kv.bias], dim=0))
+
+    # an incomplete pair is reported instead of raising a KeyError
+    state_dict = {'q.weight': mit_attn.q.weight.detach().clone()}
+    missing, unexpected = attn.load_state_dict(state_dict, strict=False)
+    assert 'qkv.weight' in missing
+    assert unexpected == ['q.weight']
+
+
+@pytest.mark.skipif(
+    not torch.cuda.is_available() or flash_window_attention.triton is None,
+    reason='requires CUDA and triton')
+@pytest.mark.parametrize('dtype', [torch.float32, torch.float16])
+def test_flash_window_attn(dtype):
+    # 8x8 window plus 10 global tokens, head_dim 64 as in the omega configs
+    B, num_heads, N, head_dim = 4, 2, 74, 64
+    scale = head_dim**-0.5
+    allow_tf32 = torch.backends.cuda.matmul.allow_tf32
+    torch.backends.cuda.matmul.allow_tf32 = False
+    try:
+        q, k, v = (
+            torch.randn(B, num_heads, N, head_dim, device='cuda',
+                        dtype=dtype).requires_grad_() for _ in range(3))
+        grad_out = torch.randn_like(q)
+        # inference only, training keeps the fused SDPA backward
+        assert not flash_window_attn_supported(q)
+        with torch.no_grad():
+            assert flash_window_attn_supported(q)
+            assert not flash_window_attn_supported(q.double())
+
+        out = flash_window_attn(q, k, v, scale)
+        grads = torch.autograd.grad(out, (q, k, v), grad_out)
+        ref = dot_product_attention(q, k, v, scale)
+        ref_grads = torch.autograd.grad(ref, (q, k, v), grad_out)
+    finally:
+        torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+
+    tol = 1e-4 if dtype == torch.float32 else 1e-2
+    assert out.dtype == dtype
+    assert torch.allclose(out, ref, atol=tol, rtol=tol)
+    for grad, ref_grad in zip(grads, ref_grads):
+        assert torch.allclose(grad, ref_grad, atol=tol, rtol=tol)
+
+
+@pytest.mark.skipif(
+    hasattr(torch.nn.Module, 'compile'), reason='requires torch<2.2')
+def test_omega_compile_requires_torch_2_2():
+    with pytest.raises(RuntimeError, match='torch>=2.2'):
+        SegFormerGTOmega(gt_num=1, compile_mlps=True)
+    if not hasattr(torch, 'compile'):
+        with pytest.raises(RuntimeError, match='torch>=2.0'):
+            SegFormerGTOmega(gt_num=1, compile_blocks=True)
+
+
+@pytest.mark.skipif(
+    not hasattr(torch.nn.Module, 'compile'), reason='requires torch>=2.2')
+def test_omega_compile_flags_conflict():
+    with pytest.warns(UserWarning, match='compile_mlps is ignored'):
+        SegFormerGTOmega(gt_num=1, compile_blocks=True, compile_mlps=True)
+
+
+@pytest.mark.skipif(
+    not hasattr(torch, 'compile'), reason='requires torch>=2.0')
+def test_omega_compile_blocks():
+    model = SegFormerGTOmega(gt_num=1)
+    model.init_weights()
+    model.eval()
+    compiled = SegFormerGTOmega(gt_num=1, compile_blocks=True)
+    compiled.init_weights()
+    compiled.load_state_dict(model.state_dict())
+    compiled.eval()
+
+    # two resolutions, the second one is not window aligned in every stage
+    for size in (64, 96):
+        img = torch.randn(1, 3, size, size)
+        with torch.no_grad():
+            outs = model(img)
+            compiled_outs = compiled(img)
+        for out, compiled_out in zip(outs, compiled_outs):
+            assert torch.allclose(out, compiled_out, atol=1e-4, rtol=1e-4)
+
+
+def test_omega_quantize_for_inference():
+    model = SegFormerGTOmega(gt_num=1)
+    model.init_weights()
+    model.eval()
+    model.quantize_for_inference()
+    assert not isinstance(model.block1[0].attn.qkv, torch.nn.Linear)
+    # kept in float, its weight also projects the positional embedding
+    assert isinstance(model.block1[0].gt_attn.qkv, torch.nn.Linear)
+
+    with torch.no_grad():
+        outs = model(torch.randn(1, 3, 64, 64))
+    assert [out.shape[1:] for out in outs] == [(64, 16, 16), (128, 8, 8),
+                                               (320, 4, 4), (512, 2, 2)]
+
+    if torch.cuda.is_available():
+        with pytest.raises(RuntimeError, match='CPU'):
+            SegFormerGTOmega(gt_num=1).cuda().quantize_for_inference()
+
+
+@pytest.mark.parametrize('H, W', [(16, 24), (13, 16), (16, 19), (13, 19),
+                                  (5, 16), (16, 3), (5, 3)])
+def test_window_reverse(H, W):
+    window_size = (8, 8)
+    B, C = 2, 3
+    Hp, Wp = -(-H // 8) * 8, -(-W // 8) * 8
+    x = torch.rand(B, Hp, Wp, C)
+    windows = window_partition(x, window_size)
+
+    # reference: reverse on the padded size, then crop
+    expected = windows.view(B, Hp // 8, Wp // 8, 8, 8, C)
+    expected = expected.permute(0, 1, 3, 2, 4, 5).contiguous().view(
+        B, Hp, Wp, C)[:, :H, :W]
+    out = window_reverse(windows, window_size, H, W)
+    assert out.shape == (B, H, W, C)
+    assert out.is_contiguous()
+    assert torch.equal(out, expected)
+
+
+def test_omega_block_inplace_residual():
+    block = Block(
+        MiTBlock(64, 1, qkv_bias=True, drop_path=0.1),
+        dim=64,
+        num_heads=1,
+        gt_num=2,
+        qkv_bias=True)
+    block.eval()
+
+    H = W = 16
+    x = torch.randn(2, H * W, 64)
+    global_token = torch.randn(2, 64)
+    # (G, C) -> (num_windows*B, G, C) stride-0 view, as in forward_features
+    gt = global_token.unsqueeze(0).expand(2 * 4, -1, -1)
+    pe = torch.randn(100, 64)
+    x_copy, global_token_copy = x.clone(), global_token.clone()
+
+    ref_x, ref_gt = block(x, H, W, gt, pe)
+    with torch.no_grad():
+        out_x, out_gt = block(x, H, W, gt, pe)
+
+    assert torch.allclose(out_x, ref_x, atol=1e-6)
+    assert torch.allclose(out_gt, ref_gt, atol=1e-6)
+    # the in-place adds never write into the skip tensors
+    assert torch.equal(x, x_copy)
+    assert torch.equal(global_token, global_token_copy)
+
+
+def test_omega_classic_attention_pe_fold():
+    attn = ClassicAttention(dim=64, num_heads=2, qkv_bias=True).double()
+    B, N, C = 3, 21, 64
+    x = torch.randn(B, N, C, dtype=torch.float64, requires_grad=True)
+    pe = torch.randn(100, C, dtype=torch.float64, requires_grad=True)
+
+    # reference: add the centered pe slice, then a plain attention
+    strt = pe.shape[0] // 2 - N // 2
+    qkv = attn.qkv(x + pe[strt:strt + N])
+    qkv = qkv.reshape(B, N, 3, 2, C // 2).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv[0], qkv[1], qkv[2]
+    weights = ((q @ k.transpose(-2, -1)) * attn.scale).softmax(dim=-1)
+    ref = attn.proj((weights @ v).transpose(1, 2).reshape(B, N, C))
+
+    out = attn(x, pe)
+    assert torch.allclose(out, ref, atol=1e-10)
+
+    inputs = (x, pe, attn.qkv.weight, attn.qkv.bias)
+    grad_out = torch.randn_like(out)
+    grads = torch.autograd.grad(out, inputs, grad_out)
+    ref_grads = torch.autograd.grad(ref, inputs, grad_out)
+    for grad, ref_grad in zip(grads, ref_grads):
+        assert torch.allclose(grad, ref_grad, atol=1e-10)